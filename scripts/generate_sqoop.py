@@ -1,19 +1,23 @@
 import argparse
 import collections
-import io
+import contextlib
 import json
 import logging
-import math
+import multiprocessing
 import string
 import time
 import random
 import sys
 import os
-from functools import partial
+from functools import lru_cache, partial
 
 import h5py
 import numpy
 from PIL import Image, ImageDraw, ImageFont
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 logger = logging.getLogger(__name__)
@@ -21,6 +25,12 @@ RELATIONS = ['left_of', 'right_of', 'above', 'below']
 COLORS = ['red', 'green', 'blue', 'yellow', 'cyan',
           'purple', 'brown', 'gray']
 SHAPES = list(string.ascii_uppercase) + ['1', '2', '3', '4', '5', '6', '7', '8', '9', '0']
+# number of examples buffered in memory between two writes to the HDF5 files
+WRITE_BATCH_SIZE = 1024
+# properties of the objects stored in the scenes file, 'shape' indexes the vocabulary
+SCENE_COLUMNS = ['shape', 'x', 'y', 'size', 'rotated_size', 'angle']
+# number of examples sent to a worker process at once
+WORKER_CHUNK_SIZE = 256
 
 
 # === Definition of modules for NMN === #
@@ -44,21 +54,78 @@ def unary_relation_module(relation):
 
 
 
+@lru_cache(maxsize=None)
+def get_object_size(fontsize):
+    """Return the size in pixels of objects drawn with the font of size `fontsize`."""
+    width, size = FONT_OBJECTS[fontsize].getsize('A')
+    return size
+
+
+@lru_cache(maxsize=None)
+def get_object_bitmap(shape, fontsize):
+    """Render `shape` with the font of size `fontsize`.
+
+    Returns the RGB tile and its alpha mask as channel-first integer arrays,
+    ready to be composited by `draw_scene`. There are only a few distinct
+    shape/font size combinations, so the bitmaps are cached and shared
+    between all scenes.
+    """
+    font = FONT_OBJECTS[fontsize]
+    size = get_object_size(fontsize)
+    img = Image.new('RGBA', (size, size))
+    draw = ImageDraw.Draw(img)
+    draw.text((0,0), shape, font=font, fill='green')
+
+    #if angle != 0:
+    #  img = img.rotate(angle, expand=True, resample=Image.LINEAR)
+
+    pixels = numpy.ascontiguousarray(numpy.asarray(img, dtype=numpy.int32).transpose(2, 0, 1))
+    return pixels[:3], pixels[3:]
+
+
+@lru_cache(maxsize=None)
+def get_bitmap_atlas():
+    """Stack the bitmaps of all shapes in all font sizes into padded arrays.
+
+    Returns the RGB tiles, the alpha masks, the size of each tile and a dict
+    mapping `(shape, fontsize)` to the index of the corresponding tile.
+    """
+    keys = [(shape, fontsize) for shape in SHAPES for fontsize in FONT_OBJECTS]
+    max_size = max(get_object_size(fontsize) for fontsize in FONT_OBJECTS)
+    rgb = numpy.zeros((len(keys), 3, max_size, max_size), dtype=numpy.int32)
+    alpha = numpy.zeros((len(keys), max_size, max_size), dtype=numpy.int32)
+    sizes = numpy.zeros(len(keys), dtype=numpy.int64)
+    for k, (shape, fontsize) in enumerate(keys):
+        tile_rgb, tile_alpha = get_object_bitmap(shape, fontsize)
+        size = tile_alpha.shape[1]
+        rgb[k, :, :size, :size] = tile_rgb
+        alpha[k, :size, :size] = tile_alpha[0]
+        sizes[k] = size
+    return rgb, alpha, sizes, {key: k for k, key in enumerate(keys)}
+
+
+def rotated_size_table(max_size):
+    """Tabulate the size of the bounding square of rotated objects.
+
+    Entry `[size, angle]` is the side of the bounding square of an object of
+    size `size` rotated by `angle` degrees.
+    """
+    angles = numpy.arange(360) / 180 * numpy.pi
+    return numpy.ceil(numpy.outer(numpy.arange(max_size + 1),
+                                  numpy.abs(numpy.sin(angles)) + numpy.abs(numpy.cos(angles)))).astype(int)
+
+
 class Object(object):
+    __slots__ = ('fontsize', 'size', 'angle', 'rotated_size', 'pos', 'shape')
+
     def __init__(self, fontsize, angle=0, pos=None, shape=None):
-        self.font = FONT_OBJECTS[fontsize]
-        width, self.size = self.font.getsize('A')
+        self.fontsize = fontsize
+        self.size = get_object_size(fontsize)
         self.angle = angle
-        angle_rad = angle / 180 * math.pi
-        self.rotated_size =  math.ceil(self.size * (abs(math.sin(angle_rad)) + abs(math.cos(angle_rad))))
+        self.rotated_size = int(ROTATED_SIZES[self.size, angle])
         self.pos = pos
         self.shape = shape
 
-    def overlap(self, other):
-        min_dist = (self.rotated_size + other.rotated_size) // 2 + 1
-        return (abs(self.pos[0] - other.pos[0]) < min_dist and
-                abs(self.pos[1] - other.pos[1]) < min_dist)
-
     def relate(self, rel, other):
         if rel == 'left_of':
             return self.pos[0] < other.pos[0]
@@ -71,51 +138,148 @@ class Object(object):
         raise ValueError(rel)
 
     def draw(self):
-        img = Image.new('RGBA', (self.size, self.size))
-        draw = ImageDraw.Draw(img)
-        draw.text((0,0), self.shape, font=self.font, fill='green')
-
-        #if self.angle != 0:
-        #  img = img.rotate(self.angle, expand=True, resample=Image.LINEAR)
-
-        return img
-
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Object):
-            return {'size': obj.size,
-                    'rotated_size': obj.rotated_size,
-                    'angle': obj.angle,
-                    'pos': obj.pos,
-                    'shape': obj.shape
-                    }
-        else:
-            return super().default(obj)
+        return get_object_bitmap(self.shape, self.fontsize)
 
+def scene_to_array(scene, vocab):
+    """Pack the objects of `scene` into an integer array with `SCENE_COLUMNS` columns."""
+    return numpy.array([(vocab.index(obj.shape), obj.pos[0], obj.pos[1],
+                         obj.size, obj.rotated_size, obj.angle) for obj in scene],
+                       dtype=numpy.int64)
 
-def draw_scene(objects):
-    img = Image.new('RGB', (args.image_size, args.image_size))
-    for obj in objects:
-        obj_img = obj.draw()
-        obj_pos = (obj.pos[0] - obj_img.size[0] // 2,
-                   obj.pos[1] - obj_img.size[1] // 2)
-        img.paste(obj_img, obj_pos, obj_img)
 
-    return img
+def _draw_bitmaps_loops(canvas, rgb, alpha, sizes, tiles, xs, ys):
+    for k in range(len(tiles)):
+        tile = tiles[k]
+        size = sizes[tile]
+        top = ys[k] - size // 2
+        left = xs[k] - size // 2
+        for i in range(size):
+            for j in range(size):
+                a = alpha[tile, i, j]
+                if a == 0:
+                    continue
+                for c in range(3):
+                    # alpha blending with the same rounding as PIL's Image.paste
+                    blended = canvas[c, top + i, left + j] * (255 - a) + rgb[tile, c, i, j] * a + 128
+                    canvas[c, top + i, left + j] = ((blended >> 8) + blended) >> 8
 
-    def relate(self, rel, other):
-        if rel == 'left_of':
-            return self.pos[0] < other.pos[0]
-        if rel == 'right_of':
-            return self.pos[0] > other.pos[0]
-        if rel == 'above':
-            return self.pos[1] > other.pos[1]
-        if rel == 'below':
-            return self.pos[1] < other.pos[1]
-        raise ValueError(rel)
 
-def get_random_spot(rng, objects, rel = None,  rel_holds = False, rel_obj = 0):
-    """Get a spot for a new object that does not overlap with existing ones."""
+# Composite the atlas tiles `tiles` centered at (xs, ys) into `canvas` in a
+# single pass. Only available when Numba is installed.
+draw_bitmaps = njit(cache=True)(_draw_bitmaps_loops) if njit is not None else None
+
+
+@lru_cache(maxsize=None)
+def get_scratch_canvas():
+    """Return the (3, H, W) integer canvas that `draw_scene` blends objects into.
+
+    The canvas is allocated once and reused by all scenes.
+    """
+    return numpy.zeros((3, args.image_size, args.image_size), dtype=numpy.int32)
+
+
+def draw_scene(objects):
+    """Composite the bitmaps of `objects` into a (3, H, W) uint8 image.
+
+    The image is channel-first, which is the layout the models consume, so
+    that it does not need to be transposed when loading the data.
+    """
+    if draw_bitmaps is not None:
+        image = numpy.zeros((3, args.image_size, args.image_size), dtype=numpy.uint8)
+        rgb, alpha, sizes, tile_idxs = get_bitmap_atlas()
+        tiles = numpy.array([tile_idxs[obj.shape, obj.fontsize] for obj in objects], dtype=numpy.int64)
+        xs = numpy.array([obj.pos[0] for obj in objects], dtype=numpy.int64)
+        ys = numpy.array([obj.pos[1] for obj in objects], dtype=numpy.int64)
+        draw_bitmaps(image, rgb, alpha, sizes, tiles, xs, ys)
+        return image
+
+    canvas = get_scratch_canvas()
+    canvas.fill(0)
+    for obj in objects:
+        rgb, alpha = obj.draw()
+        height, width = alpha.shape[1:]
+        left = obj.pos[0] - width // 2
+        top = obj.pos[1] - height // 2
+        region = canvas[:, top:top + height, left:left + width]
+        # alpha blending with the same rounding as PIL's Image.paste
+        blended = region * (255 - alpha) + rgb * alpha + 128
+        region[...] = ((blended >> 8) + blended) >> 8
+
+    return canvas.astype(numpy.uint8)
+
+def placement_arrays(objects, capacity=None):
+    """Return the positions and rotated sizes of `objects` as parallel arrays.
+
+    The arrays have room for `capacity` objects, so that a scene under
+    construction can keep appending to them.
+    """
+    if capacity is None:
+        capacity = len(objects)
+    pos_x = numpy.zeros(capacity, dtype=numpy.int64)
+    pos_y = numpy.zeros(capacity, dtype=numpy.int64)
+    rotated_sizes = numpy.zeros(capacity, dtype=numpy.int64)
+    for k, obj in enumerate(objects):
+        pos_x[k], pos_y[k] = obj.pos
+        rotated_sizes[k] = obj.rotated_size
+    return pos_x, pos_y, rotated_sizes
+
+
+def _find_free_spot_numpy(pos_x, pos_y, rotated_sizes, rotated_size, xs, ys):
+    dx = numpy.abs(pos_x[:, None] - xs[None, :])
+    dy = numpy.abs(pos_y[:, None] - ys[None, :])
+
+    # make sure the objects are not aligned, in crowded scenes this alone
+    # often rejects all attempts
+    rejected = (numpy.minimum(dx, dy) < 5).any(axis=0)
+    if rejected.all():
+        return -1
+
+    # make sure there is no overlap between bounding squares, i.e. the
+    # Chebyshev distance between the objects is large enough
+    min_dist = ((rotated_sizes + rotated_size) // 2 + 1)[:, None]
+    rejected |= (numpy.maximum(dx, dy) < min_dist).any(axis=0)
+    if rejected.all():
+        return -1
+    return rejected.argmin()
+
+
+def _find_free_spot_loops(pos_x, pos_y, rotated_sizes, rotated_size, xs, ys):
+    for attempt in range(len(xs)):
+        free = True
+        for k in range(len(pos_x)):
+            dx = abs(pos_x[k] - xs[attempt])
+            dy = abs(pos_y[k] - ys[attempt])
+            min_dist = (rotated_sizes[k] + rotated_size) // 2 + 1
+            # make sure the objects are not aligned and there is no overlap
+            # between bounding squares
+            if min(dx, dy) < 5 or max(dx, dy) < min_dist:
+                free = False
+                break
+        if free:
+            return attempt
+    return -1
+
+
+# Return the index of the first candidate position (xs[i], ys[i]) for an object
+# of size `rotated_size` that is free given the placed objects, or -1 if there
+# is none. The explicit loops are compiled when Numba is available.
+#
+# Both versions scan all placed objects rather than a spatial index: objects
+# may not be aligned, i.e. closer than 5 pixels along either axis, which is a
+# constraint over whole rows and columns, and it caps scenes at about
+# image_size / 5 objects anyway.
+if njit is not None:
+    find_free_spot = njit(cache=True)(_find_free_spot_loops)
+else:
+    find_free_spot = _find_free_spot_numpy
+
+
+def get_random_spot(rng, objects, rel = None,  rel_holds = False, rel_obj = 0, placed = None):
+    """Get a spot for a new object that does not overlap with existing ones.
+
+    `placed` holds `placement_arrays(objects)`; it is computed on the fly
+    when not given.
+    """
     # then, select the object size
     size = rng.randint(args.min_obj_size, args.max_obj_size + 1)
     angle = rng.randint(0, 360) if args.rotate else 0
@@ -145,21 +309,18 @@ def get_random_spot(rng, objects, rel = None,  rel_holds = False, rel_obj = 0):
         min_center_x = min_center_y = min_center
         max_center_x = max_center_y = max_center
 
+    if placed is None:
+        placed = placement_arrays(objects)
+    pos_x, pos_y, rotated_sizes = placed
 
-    for attempt in range(10):
-        x = rng.randint(min_center_x, max_center_x)
-        y = rng.randint(min_center_y, max_center_y)
-        obj.pos = (x, y)
-
-        # make sure there is no overlap between bounding squares
-        if (any([abs(obj.pos[0] - other.pos[0]) < 5 for other in objects]) or
-            any([abs(obj.pos[1] - other.pos[1]) < 5 for other in objects])):
-            continue
-        if any([obj.overlap(other) for other in objects]):
-            continue
-        return obj
-    else:
+    # draw all 10 attempts at once and check them against all placed objects
+    xs = rng.randint(min_center_x, max_center_x, size=10)
+    ys = rng.randint(min_center_y, max_center_y, size=10)
+    attempt = find_free_spot(pos_x, pos_y, rotated_sizes, obj.rotated_size, xs, ys)
+    if attempt < 0:
         return None
+    obj.pos = (int(xs[attempt]), int(ys[attempt]))
+    return obj
 
 
 def generate_scene(rng, sampler, objects=[], restrict = False, **kwargs):
@@ -167,17 +328,22 @@ def generate_scene(rng, sampler, objects=[], restrict = False, **kwargs):
 
     objects = list(orig_objects)
     place_failures = 0
+    num_objects = args.num_objects
+    pos_x, pos_y, rotated_sizes = placement_arrays(
+        objects, max(num_objects, len(objects)))
 
     if restrict:
         restricted_obj = [obj.shape for obj in orig_objects]
     else:
         restricted_obj = []
 
-    while len(objects) < args.num_objects:
-        # first, select which object to draw by rejection sampling
+    while len(objects) < num_objects:
+        # first, select which object to draw
         shape = sampler.sample_object(restricted_obj, [], **kwargs)
 
-        new_object = get_random_spot(rng, objects)
+        n = len(objects)
+        new_object = get_random_spot(
+            rng, objects, placed=(pos_x[:n], pos_y[:n], rotated_sizes[:n]))
         if new_object is None:
             place_failures += 1
             if place_failures == 10:
@@ -187,25 +353,80 @@ def generate_scene(rng, sampler, objects=[], restrict = False, **kwargs):
             continue
 
         new_object.shape = shape
+        pos_x[n], pos_y[n] = new_object.pos
+        rotated_sizes[n] = new_object.rotated_size
         objects.append(new_object)
 
     return objects
 
 
+class RandomPool:
+    """Serve random numbers from blocks pre-generated by a RandomState.
+
+    Implements the part of the RandomState interface used for scene
+    generation. Integers are derived from uniform floats, so that one block
+    serves draws of any range and a single NumPy call is amortized over many
+    small draws.
+    """
+    def __init__(self, rng, block_size=1024):
+        self._rng = rng
+        self._block_size = block_size
+        self._block = rng.random_sample(block_size)
+        self._cursor = 0
+
+    def random_sample(self, size=None):
+        num_samples = 1 if size is None else size
+        if self._cursor + num_samples > len(self._block):
+            self._block = self._rng.random_sample(max(self._block_size, num_samples))
+            self._cursor = 0
+        samples = self._block[self._cursor:self._cursor + num_samples]
+        self._cursor += num_samples
+        return samples[0] if size is None else samples
+
+    def randint(self, low, high=None, size=None):
+        if high is None:
+            low, high = 0, low
+        samples = self.random_sample(size) * (high - low)
+        if size is None:
+            return low + int(samples)
+        return low + samples.astype(numpy.int64)
+
+
 class Sampler:
     def __init__(self, test, seed, objects):
         self._test = test
         self._rng = numpy.random.RandomState(seed)
         self.objects = objects
+        self._object_bits = {obj: 1 << k for k, obj in enumerate(objects)}
+        self._allowed = {}
+
+    def seed(self, seed):
+        self._rng = numpy.random.RandomState(seed)
 
     def _choose(self, list_like):
         return list_like[self._rng.randint(len(list_like))]
 
-    def _rejection_sample(self, restricted=[]):
-        while True:
-            rand_object = self._rng.choice(self.objects)
-            if rand_object not in restricted:
-                return rand_object
+    def _allowed_objects(self, restricted, shape_probs=None):
+        """Return the objects not in `restricted` and their cumulative probabilities.
+
+        The result is cached per set of restricted objects, packed as a
+        bitmask over object indices. `shape_probs` is assumed to be the same
+        for all calls on a given sampler.
+        """
+        mask = 0
+        for obj in restricted:
+            mask |= self._object_bits[obj]
+        if mask not in self._allowed:
+            if shape_probs is None:
+                shape_probs = [1.0] * len(self.objects)
+            allowed = [k for k in range(len(self.objects)) if not (mask >> k) & 1]
+            cdf = numpy.cumsum(numpy.asarray(shape_probs, dtype=float)[allowed])
+            self._allowed[mask] = ([self.objects[k] for k in allowed], cdf / cdf[-1])
+        return self._allowed[mask]
+
+    def _sample_allowed(self, restricted=[]):
+        allowed, cdf = self._allowed_objects(restricted)
+        return allowed[cdf.searchsorted(self._rng.random_sample(), side='right')]
 
     def sample_relation(self, *args, **kwargs):
         return self._choose(RELATIONS)
@@ -213,9 +434,9 @@ class Sampler:
     def sample_object(self, *args, **kwargs):
         print(args)
         if len(args) > 0:
-            return self._rejection_sample(args[0])
+            return self._sample_allowed(args[0])
         else:
-            return self._rejection_sample()
+            return self._sample_allowed()
 
 
 class _LongTailSampler(Sampler):
@@ -225,15 +446,13 @@ class _LongTailSampler(Sampler):
 
     def sample_object(self, restricted = [], *args, **kwargs):
         if self._test:
-            return self._rejection_sample(restricted = restricted)
+            return self._sample_allowed(restricted = restricted)
         else:
-            return self._rejection_sample(self.object_probs, restricted = restricted)
+            return self._sample_allowed(self.object_probs, restricted = restricted)
 
-    def _rejection_sample(self, shape_probs=None, restricted = []):
-        while True:
-            rand_object = self._rng.choice(self.objects, p = shape_probs)
-            if rand_object not in restricted:
-                return rand_object
+    def _sample_allowed(self, shape_probs=None, restricted = []):
+        allowed, cdf = self._allowed_objects(restricted, shape_probs)
+        return allowed[cdf.searchsorted(self._rng.random_sample(), side='right')]
 
 
 
@@ -241,70 +460,174 @@ def LongTailSampler(long_tail_dist):
     return partial(_LongTailSampler, long_tail_dist)
 
 
-def gen_data(obj_pairs, sampler, seed, vocab, prefix, question_vocab, program_vocab):
-    num_examples = len(obj_pairs)
-
-    max_question_len = 3
+def build_program(x, rel, y):
+    """Return the program for the question "x rel y"."""
     if args.program == 'best':
-        max_program_len = 7
-    elif args.program in ['chain', 'chain2', 'chain3']:
-        max_program_len = 6
+        return ["<START>", relation_module(rel),
+                shape_module(x), "scene",
+                shape_module(y), "scene",
+                "<END>"]
+    elif args.program == 'chain':
+        return ["<START>",
+                shape_module(x),
+                unary_relation_module(rel),
+                shape_module(y),
+                "scene",
+                "<END>"]
+    elif args.program == 'chain2':
+        return ["<START>",
+                shape_module(x),
+                shape_module(y),
+                unary_relation_module(rel),
+                "scene",
+                "<END>"]
+    elif args.program == 'chain3':
+        return ["<START>",
+                unary_relation_module(rel),
+                shape_module(x),
+                shape_module(y),
+                "scene",
+                "<END>"]
     elif args.program == 'chain_shortcut':
-        max_program_len = 8
+        return ["<START>",
+                binary_shape_module(x), 'scene',
+                unary_relation_module(rel),
+                binary_shape_module(y), 'scene',
+                'scene',
+                "<END>"]
+    raise ValueError(args.program)
+
+
+def token_tables(vocab, question_vocab, program_vocab):
+    """Tabulate the question and program token ids of all possible questions.
+
+    Both tables are indexed by `[x, rel, y]`, where `x` and `y` index `vocab`
+    and `rel` indexes `RELATIONS`. Token ids are stored with the smallest
+    unsigned integer type that fits the vocabulary.
+    """
+    questions = [[[[question_vocab[w] for w in [x, rel, y]]
+                   for y in vocab] for rel in RELATIONS] for x in vocab]
+    programs = [[[[program_vocab[w] for w in build_program(x, rel, y)]
+                  for y in vocab] for rel in RELATIONS] for x in vocab]
+    return (numpy.array(questions, dtype=numpy.min_scalar_type(len(question_vocab) - 1)),
+            numpy.array(programs, dtype=numpy.min_scalar_type(len(program_vocab) - 1)))
+
+
+def gen_data(obj_pairs, sampler, seed, vocab, prefix, question_vocab, program_vocab):
+    num_examples = len(obj_pairs)
 
     presampled_relations = [sampler.sample_relation() for ex in obj_pairs] # pre-sample relations
-    with h5py.File(prefix + '_questions.h5', 'w') as dst_questions, h5py.File(prefix + '_features.h5', 'w') as dst_features:
-        features_dtype = h5py.special_dtype(vlen=numpy.dtype('uint8'))
-        features_dataset = dst_features.create_dataset('features', (num_examples,), dtype=features_dtype)
-        questions_dataset = dst_questions.create_dataset('questions', (num_examples, max_question_len), dtype=numpy.int64)
-        programs_dataset = dst_questions.create_dataset('programs', (num_examples, max_program_len), dtype=numpy.int64)
-        answers_dataset = dst_questions.create_dataset('answers', (num_examples,), dtype=numpy.int64)
-        image_idxs_dataset = dst_questions.create_dataset('image_idxs', (num_examples,), dtype=numpy.int64)
-
-        i = 0
+
+    # questions and programs do not depend on the scene, look them all up at once
+    question_table, program_table = token_tables(vocab, question_vocab, program_vocab)
+    shape_idxs = {shape: idx for idx, shape in enumerate(vocab)}
+    relation_idxs = {rel: idx for idx, rel in enumerate(RELATIONS)}
+    lhs_idxs = numpy.array([shape_idxs[x] for x, y in obj_pairs], dtype=numpy.int64)
+    rhs_idxs = numpy.array([shape_idxs[y] for x, y in obj_pairs], dtype=numpy.int64)
+    rel_idxs = numpy.array([relation_idxs[rel] for rel in presampled_relations], dtype=numpy.int64)
+    questions = question_table[lhs_idxs, rel_idxs, rhs_idxs]
+    programs = program_table[lhs_idxs, rel_idxs, rhs_idxs]
+
+    with contextlib.ExitStack() as files:
+        dst_questions = files.enter_context(h5py.File(prefix + '_questions.h5', 'w'))
+        image_shape = (3, args.image_size, args.image_size)
+        features_dataset = None
+        if not args.no_render:
+            dst_features = files.enter_context(h5py.File(prefix + '_features.h5', 'w'))
+            features_dataset = dst_features.create_dataset(
+                'features', (num_examples,) + image_shape, dtype=numpy.uint8,
+                chunks=(1,) + image_shape, compression='lzf')
+        questions_dataset = dst_questions.create_dataset('questions', questions.shape, dtype=questions.dtype)
+        programs_dataset = dst_questions.create_dataset('programs', programs.shape, dtype=programs.dtype)
+        answers_dataset = dst_questions.create_dataset('answers', (num_examples,), dtype=numpy.uint8)
+        image_idxs_dataset = dst_questions.create_dataset('image_idxs', (num_examples,), dtype=numpy.uint32)
+
+        batch_size = min(WRITE_BATCH_SIZE, num_examples)
+        if features_dataset is not None:
+            features_buffer = numpy.empty((batch_size,) + image_shape, dtype=numpy.uint8)
+        answers_buffer = numpy.empty((batch_size,), dtype=numpy.uint8)
+
         rejection_sampling = {'a' : 0, 'b' : 0, 'c' : 0, 'd' : 0, 'e' : 0, 'f' : 0}
 
-        # different seeds for train/dev/test
-        rng = numpy.random.RandomState(seed)
+        tasks = ((i, obj_pairs[i], presampled_relations[i], (i % 2) == 0)
+                 for i in range(num_examples))
+        examples = map_examples(partial(gen_example, sampler, seed, vocab), tasks)
+
         before = time.time()
-        scenes = []
-        while i < len(obj_pairs):
-            scene, question, program, success, key = generate_image_and_question(
-                obj_pairs[i], sampler, rng, (i % 2) == 0, vocab, presampled_relations[i])
-            rejection_sampling[key] += 1
-            if success:
-                scenes.append(scene)
-                buffer_ = io.BytesIO()
-                image = draw_scene(scene)
-                image.save(buffer_, format='png')
-                buffer_.seek(0)
-                features_dataset[i]   = numpy.frombuffer(buffer_.read(), dtype='uint8')
-                questions_dataset[i]  = [question_vocab[w] for w in question]
-                programs_dataset[i]   = [program_vocab[w] for w in program]
-                answers_dataset[i]    = int( (i%2) == 0)
-                image_idxs_dataset[i] = i
-
-                i += 1
-                if i % 1000 == 0:
-                    time_data = "{} seconds per example".format((time.time() - before) / i )
-                    print(time_data)
-                print("\r>> Done with %d/%d examples : %s " %(i+1, len(obj_pairs),  rejection_sampling), end = '')
-                sys.stdout.flush()
+        scenes = numpy.zeros((num_examples, args.num_objects, len(SCENE_COLUMNS)), dtype=numpy.int64)
+        for i, (scene, image, rejections) in enumerate(examples):
+            for key, count in rejections.items():
+                rejection_sampling[key] += count
+            scenes[i] = scene
+            j = i % batch_size
+            if features_dataset is not None:
+                features_buffer[j] = image
+            answers_buffer[j]   = int( (i%2) == 0)
+
+            if j + 1 == batch_size or i + 1 == num_examples:
+                # flush the buffered examples
+                start, stop = i - j, i + 1
+                if features_dataset is not None:
+                    features_dataset[start:stop] = features_buffer[:j + 1]
+                questions_dataset[start:stop]  = questions[start:stop]
+                programs_dataset[start:stop]   = programs[start:stop]
+                answers_dataset[start:stop]    = answers_buffer[:j + 1]
+                image_idxs_dataset[start:stop] = numpy.arange(start, stop)
+            if (i + 1) % 1000 == 0:
+                time_data = "{} seconds per example".format((time.time() - before) / (i + 1))
+                print(time_data)
+            print("\r>> Done with %d/%d examples : %s " %(i+1, len(obj_pairs),  rejection_sampling), end = '')
+            sys.stdout.flush()
 
     print("{} seconds per example".format((time.time() - before) / len(obj_pairs) ))
 
     with open(prefix + '_scenes.json', 'w') as dst:
-        json.dump(scenes, dst, indent=2, cls=CustomJSONEncoder)
+        # one [num_examples, num_objects] list per column
+        columns = {column: scenes[:, :, k].tolist() for k, column in enumerate(SCENE_COLUMNS)}
+        json.dump(dict(columns, vocab=vocab), dst)
+
+
+def map_examples(func, tasks):
+    """Apply `func` to `tasks` in order, using `args.num_workers` processes."""
+    if args.num_workers <= 1:
+        yield from map(func, tasks)
+        return
+    with multiprocessing.get_context('fork').Pool(args.num_workers) as pool:
+        yield from pool.imap(func, tasks, chunksize=WORKER_CHUNK_SIZE)
+
+
+def gen_example(sampler, seed, vocab, task):
+    """Generate the scene and the image of the example described by `task`.
+
+    The scene is returned packed by `scene_to_array`. The image is None
+    when rendering is disabled with `--no-render`.
 
+    Every example gets its own random streams derived from `seed` and its
+    index, so the generated data does not depend on how the examples are
+    distributed across worker processes.
+    """
+    i, pair, rel, label = task
+    scene_seed, sampler_seed = numpy.random.SeedSequence(seed, spawn_key=(i,)).spawn(2)
+    rng = RandomPool(numpy.random.RandomState(numpy.random.MT19937(scene_seed)))
+    sampler.seed(numpy.random.MT19937(sampler_seed))
 
-def generate_image_and_question(pair, sampler, rng, label, vocab, rel):
+    rejections = collections.Counter()
+    while True:
+        scene, success, key = generate_image(pair, sampler, rng, label, vocab, rel)
+        rejections[key] += 1
+        if success:
+            image = None if args.no_render else draw_scene(scene)
+            return scene_to_array(scene, vocab), image, rejections
+
+
+def generate_image(pair, sampler, rng, label, vocab, rel):
     # x rel y has value label where pair == (x, y)
 
     x,y = pair
     if label:
         obj1 = get_random_spot(rng, [])
         obj2 = get_random_spot(rng, [obj1])
-        if not obj2 or not obj1.relate(rel, obj2): return None, None, None, False, 'a'
+        if not obj2 or not obj1.relate(rel, obj2): return None, False, 'a'
         obj1.shape = x
         obj2.shape = y
         scene = generate_scene(rng, sampler, objects=[obj1, obj2], restrict = False, relation=rel)
@@ -312,7 +635,7 @@ def generate_image_and_question(pair, sampler, rng, label, vocab, rel):
         # first generate a scene
         obj1 = get_random_spot(rng, [])
         obj2 = get_random_spot(rng, [obj1], rel = rel, rel_holds = False)
-        if not obj2 or obj1.relate(rel, obj2): return None, None, None, False, 'b'
+        if not obj2 or obj1.relate(rel, obj2): return None, False, 'b'
         obj1.shape = x
         obj2.shape = y
 
@@ -323,49 +646,10 @@ def generate_image_and_question(pair, sampler, rng, label, vocab, rel):
         obj3 = scene[2] #x'
         obj4 = scene[3] #y'
 
-        if not obj1.relate(rel, obj4): return None, None, None, False, 'c'
-        elif not obj3.relate(rel, obj2): return None, None, None, False, 'd'
-
-    color1 = "green"
-    color2 = "green"
-    shape1 = x
-    shape2 = y
-    question = [x, rel, y]
-    if args.program == 'best':
-        program = ["<START>", relation_module(rel),
-                   shape_module(shape1), "scene",
-                   shape_module(shape2), "scene",
-                   "<END>"]
-    elif args.program == 'chain':
-        program = ["<START>",
-                   shape_module(shape1),
-                   unary_relation_module(rel),
-                   shape_module(shape2),
-                   "scene", 
-                   "<END>"]
-    elif args.program == 'chain2':
-        program = ["<START>",
-                   shape_module(shape1), 
-                   shape_module(shape2),
-                   unary_relation_module(rel),
-                   "scene", 
-                   "<END>"]
-    elif args.program == 'chain3':
-        program = ["<START>",
-                   unary_relation_module(rel),
-                   shape_module(shape1),
-                   shape_module(shape2),
-                   "scene", 
-                   "<END>"]
-    elif args.program == 'chain_shortcut':
-        program = ["<START>",
-                   binary_shape_module(shape1), 'scene',
-                   unary_relation_module(rel),
-                   binary_shape_module(shape2), 'scene',
-                   'scene', 
-                   "<END>"]
+        if not obj1.relate(rel, obj4): return None, False, 'c'
+        elif not obj3.relate(rel, obj2): return None, False, 'd'
 
-    return scene, question, program, True, 'f'
+    return scene, True, 'f'
 
 
 def gen_sqoop(vocab):
@@ -519,7 +803,16 @@ if __name__ == '__main__':
     parser.add_argument('--max-obj-size', type=int, default=15)
     parser.add_argument('--no-rotate', action='store_false', dest='rotate')
     parser.add_argument('--font', default='arial.ttf')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of processes generating examples in parallel')
+    parser.add_argument('--no-render', action='store_true',
+                        help='do not draw the images and do not write the features files, '
+                             'only the questions, programs, answers and scenes')
     args = parser.parse_args()
+    if args.num_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        # the workers rely on inheriting `args`, `FONT_OBJECTS` and `ROTATED_SIZES`
+        parser.error('--num-workers > 1 requires the fork start method, '
+                     'which is not available on this platform')
 
     args.level = 'relations'
     data_full_dir = "%s/sqoop-variety_%d-repeats_%d" %(args.data_dir, args.rhs_variety, args.num_repeats)
@@ -533,6 +826,7 @@ if __name__ == '__main__':
         print(args, file=dst)
 
     FONT_OBJECTS = { font_size : ImageFont.truetype(args.font) for font_size in range(10, 16) }
+    ROTATED_SIZES = rotated_size_table(max(get_object_size(font_size) for font_size in FONT_OBJECTS))
 
     vocab = SHAPES[:args.num_shapes]
     if args.mode == 'sqoop':
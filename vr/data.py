@@ -89,6 +89,10 @@ class ClevrDataset(Dataset):
         # Open the feature or load them if requested
         if not self.feature_h5:
             self.feature_h5 = h5py.File(self.feature_h5_path, 'r')
+            features = self.feature_h5['features']
+            if features.ndim == 4 and features.dtype == np.uint8:
+                # raw images are too large to keep in memory, read them row by row
+                self.load_features = False
             if self.load_features:
                 self.features = self.feature_h5['features'].value
 
@@ -115,6 +119,8 @@ class ClevrDataset(Dataset):
             feats = self.feature_h5['features'][image_idx]
         if feats.ndim == 1:
             feats = np.array(PIL.Image.open(io.BytesIO(feats))).transpose(2, 0, 1) / 255.0
+        elif feats.dtype == np.uint8:
+            feats = feats / 255.0
         feats = torch.FloatTensor(np.asarray(feats, dtype=np.float32))
 
         program_json = None